@@ -1,53 +1,180 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import copy
+import functools
+import hashlib
+import io
+import itertools
+import json
 import os
+import numpy as np
 import torchvision.datasets as datasets
 from torch.utils.data import DataLoader
 import torchvision
+import torchvision.transforms.v2
 import torch
 import subprocess
+import tarfile
+import types
 from glob import glob
 
 from src.utils import AugmentationSwitch, DatasetSwitch
 from src import paths
 
-registered_datasets = {}
+_registered_datasets = {}
+_registered_dataset_roots = {}
 
 
 class GaussianISONoise(torch.nn.Module):
     """Add Gaussian noise to an image with a given standard deviation.
+    The noise is added in-place and its buffer is reused while the input shape
+    stays the same, so applying it to whole batches does not allocate per call.
+    Inside dataloader workers the per-worker generator created by
+    _worker_init_fn is used unless a generator is given.
     Args:
         std (float): standard deviation of the Gaussian noise
+        generator (torch.Generator): optional generator to draw the noise from
     """
 
-    def __init__(self, std: float):
+    def __init__(self, std: float, generator: torch.Generator = None):
         super().__init__()
         self.std = std
+        self.generator = generator
+        self._noise = None
+
+    def _get_generator(self, device):
+        generator = self.generator
+        if generator is None:
+            worker_info = torch.utils.data.get_worker_info()
+            if worker_info is not None:
+                generator = getattr(worker_info.dataset, "noise_generator", None)
+        if generator is not None and generator.device != device:
+            return None
+        return generator
 
     def forward(self, in_tensor: torch.Tensor) -> torch.Tensor:
-        return in_tensor + torch.randn_like(in_tensor) * self.std
+        if self.std == 0:
+            return in_tensor
+        if (
+            self._noise is None
+            or self._noise.shape != in_tensor.shape
+            or self._noise.dtype != in_tensor.dtype
+            or self._noise.device != in_tensor.device
+        ):
+            self._noise = torch.empty_like(in_tensor)
+        generator = self._get_generator(in_tensor.device)
+        self._noise.normal_(0, self.std, generator=generator)
+        return in_tensor.add_(self._noise)
 
     def __repr__(self) -> str:
-        return f"{self.__class__.__name__}(sigma={self.p})"
+        return f"{self.__class__.__name__}(sigma={self.std})"
 
     def __str__(self):
         return super().__str__() + f" with std={self.std}"
 
 
+class SeparableGaussianBlur(torch.nn.Module):
+    """Gaussian blur as two depthwise 1D convolutions with a precomputed kernel.
+    Matches torchvision's GaussianBlur (reflect padding) and works on single
+    images (C, H, W) as well as batches (B, C, H, W).
+    Args:
+        ksize (int): odd size of the kernel
+        sigma (float): standard deviation of the Gaussian kernel
+    """
+
+    def __init__(self, ksize: int, sigma: float):
+        super().__init__()
+        self.ksize = ksize
+        self.sigma = sigma
+        half = (ksize - 1) * 0.5
+        kernel = torch.linspace(-half, half, ksize)
+        kernel = torch.exp(-0.5 * (kernel / sigma).pow(2))
+        kernel = kernel / kernel.sum()
+        self.register_buffer("kh", kernel.view(1, 1, 1, ksize))
+        self.register_buffer("kv", kernel.view(1, 1, ksize, 1))
+
+    def forward(self, in_tensor: torch.Tensor) -> torch.Tensor:
+        x = in_tensor.as_subclass(torch.Tensor)
+        unbatched = x.ndim == 3
+        if unbatched:
+            x = x.unsqueeze(0)
+        channels = x.shape[-3]
+        pad = self.ksize // 2
+        kh = self.kh.to(x.dtype).expand(channels, 1, 1, self.ksize)
+        kv = self.kv.to(x.dtype).expand(channels, 1, self.ksize, 1)
+        x = torch.nn.functional.pad(x, (pad, pad, pad, pad), mode="reflect")
+        x = torch.nn.functional.conv2d(x, kh, groups=channels)
+        x = torch.nn.functional.conv2d(x, kv, groups=channels)
+        return x.squeeze(0) if unbatched else x
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(ksize={self.ksize}, sigma={self.sigma})"
+
+
+def get_batch_aug(
+    augmentation,
+    gaussian_noise_var,
+    gaussian_blur_var,
+):
+    """Stochastic augmentations that run on whole batches once they are on the
+    device, instead of per sample inside the dataloader workers.
+    """
+    batch_augmentations = []
+    if augmentation == AugmentationSwitch.TRAIN:
+        if gaussian_noise_var > 0:
+            batch_augmentations.append(GaussianISONoise(gaussian_noise_var))
+        if gaussian_blur_var > 0:
+            batch_augmentations.append(SeparableGaussianBlur(5, gaussian_blur_var))
+    return torch.nn.Sequential(*batch_augmentations)
+
+
 def register_dataset(name):
     def decorator(func):
         str_name = str(name)
         # we make sure that the path is set in paths.py
         func.__root_path__ = getattr(paths, f"{str_name.upper()}_ROOT")
         # we register the function
-        registered_datasets[name] = func
+        _registered_datasets[name] = func
+        _registered_dataset_roots[name] = func.__root_path__
         return func
 
     return decorator
 
 
+def run_with_bounded_output(command, max_lines=100):
+    """Runs a command without a shell, discarding its stdout and keeping only the
+    last max_lines of its stderr. Capturing everything makes long rsync/fpsync
+    runs accumulate their whole progress output in memory.
+    Returns:
+        (int, str): the return code and the tail of stderr.
+    """
+    process = subprocess.Popen(
+        command,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    stderr_tail = deque(process.stderr, maxlen=max_lines)
+    process.wait()
+    return process.returncode, "".join(stderr_tail)
+
+
+def add_fpart_to_env():
+    """Makes fpsync resolvable for the subprocesses started here, instead of a
+    `module load` in a child shell whose environment is lost when it exits.
+    """
+    if paths.FPART_ROOT is None:
+        return
+    for name, sub_dir in (("PATH", "bin"), ("LD_LIBRARY_PATH", "lib")):
+        entry = os.path.join(paths.FPART_ROOT, sub_dir)
+        current = os.environ.get(name, "")
+        if entry not in current.split(os.pathsep):
+            os.environ[name] = os.pathsep.join(filter(None, (entry, current)))
+
+
 def move_output_compute_node(COMPUTE_OUTPUT_DIR, experiment_output_dir):
 
-    result = subprocess.run(
+    returncode, stderr = run_with_bounded_output(
         [
             "time",
             "fpsync",
@@ -60,15 +187,13 @@ def move_output_compute_node(COMPUTE_OUTPUT_DIR, experiment_output_dir):
             COMPUTE_OUTPUT_DIR,
             experiment_output_dir,
         ],
-        capture_output=True,
-        text=True,
     )
-    if result.returncode != 0:
-        raise RuntimeError(f"Failed to sync output: {result.stderr}")
+    if returncode != 0:
+        raise RuntimeError(f"Failed to sync output: {stderr}")
 
 
 def resolve_data_directories(args):
-    DATA_DIR = registered_datasets[args["dataset"]].__root_path__
+    DATA_DIR = registered_dataset_roots[args["dataset"]]
 
     # If port is 0, we are debugging locally
     if args["port"] == 0:
@@ -105,18 +230,35 @@ def resolve_data_directories(args):
     )
 
 
+def extract_archive(path, dest):
+    # streaming mode reads the archive once front to back, compression is detected
+    try:
+        with tarfile.open(path, mode="r|*") as archive:
+            # explicit filter, the default differs between python versions
+            if hasattr(tarfile, "data_filter"):
+                archive.extractall(dest, filter="data")
+            else:
+                archive.extractall(dest)
+    except (tarfile.TarError, OSError) as e:
+        return f"{path}: {e}"
+    return None
+
+
 def extract_the_dataset_on_compute_node(
     COMPUTE_DATA_DIR,
     EXT,
     COMPUTE_DATA_DIR_BASE_DIR,
 ):
-    result = subprocess.run(
-        f"time ls {COMPUTE_DATA_DIR}*.{EXT} | xargs -n 1 -P 8 -I @ tar -xf @ -C {COMPUTE_DATA_DIR_BASE_DIR}",
-        capture_output=True,
-        text=True,
-        shell=True,
-    )
-    if result.returncode != 0:
+    files = sorted(glob(f"{COMPUTE_DATA_DIR}*.{EXT}"))
+    with ProcessPoolExecutor(max_workers=8) as executor:
+        errors = executor.map(
+            functools.partial(extract_archive, dest=COMPUTE_DATA_DIR_BASE_DIR),
+            files,
+        )
+        errors = [error for error in errors if error is not None]
+    for error in errors:
+        print(f"Failed to extract {error}")
+    if errors:
         raise RuntimeError("Failed to extract data")
 
 
@@ -126,7 +268,7 @@ def move_data_to_compute_node(
     COMPUTE_DATA_DIR,
 ):
     if IS_COMPRESSED:
-        result = subprocess.run(
+        returncode, stderr = run_with_bounded_output(
             [
                 "time",
                 "rsync",
@@ -135,11 +277,9 @@ def move_data_to_compute_node(
                 DATA_DIR,
                 COMPUTE_DATA_DIR,
             ],
-            capture_output=True,
-            text=True,
         )
     else:
-        result = subprocess.run(
+        returncode, stderr = run_with_bounded_output(
             [
                 "time",
                 "fpsync",
@@ -152,11 +292,219 @@ def move_data_to_compute_node(
                 DATA_DIR,
                 COMPUTE_DATA_DIR,
             ],
-            capture_output=True,
-            text=True,
         )
-    if result.returncode != 0:
-        raise RuntimeError(f"Failed to sync data: {result.stderr}")
+    if returncode != 0:
+        raise RuntimeError(f"Failed to sync data: {stderr}")
+
+
+STOCHASTIC_TRANSFORMS = (
+    GaussianISONoise,
+    torchvision.transforms.v2.RandomResizedCrop,
+    torchvision.transforms.v2.RandomChoice,
+    torchvision.transforms.v2.RandomHorizontalFlip,
+    torchvision.transforms.v2.ColorJitter,
+)
+
+
+def split_cacheable_transform(transform, cacheable):
+    """Splits a Compose after its leading run of cacheable transforms, so that the
+    cached prefix stays a uint8 image and the conversion to float runs on every read.
+    Args:
+        transform (Compose): the transform of the dataset.
+        cacheable (tuple): types of the transforms that may be cached.
+    Returns:
+        (Compose, Compose): the cached prefix and the remaining transforms.
+    """
+    transforms = list(transform.transforms)
+    split = next(
+        (i for i, t in enumerate(transforms) if not isinstance(t, cacheable)),
+        len(transforms),
+    )
+    return (
+        torchvision.transforms.v2.Compose(transforms[:split]),
+        torchvision.transforms.v2.Compose(transforms[split:]),
+    )
+
+
+# decoding and resizing keep the image uint8, the conversion to float is not
+# cached so that the cache holds a quarter of the bytes
+DISK_CACHEABLE_TRANSFORMS = (
+    torchvision.transforms.v2.ToImage,
+    torchvision.transforms.v2.Resize,
+)
+
+
+def is_worth_caching(transform):
+    """Only a cached prefix that resizes makes the cached tensors smaller
+    than the images they replace. Without a resize (e.g. the ImageNet train split,
+    where the crop is the first random transform) the cache would hold every
+    image decoded at full resolution.
+    """
+    cached, _ = split_cacheable_transform(transform, DISK_CACHEABLE_TRANSFORMS)
+    return any(
+        isinstance(t, torchvision.transforms.v2.Resize) for t in cached.transforms
+    )
+
+
+class CachedDeterministicDataset(torch.utils.data.Dataset):
+    """Caches the decoded and resized uint8 images of a dataset on disk, so that
+    only the normalization and the stochastic transforms run every epoch.
+    Args:
+        dataset (torch.utils.data.Dataset): dataset whose transform is a Compose.
+        cache_dir (str): prefix of the directory where the {idx}.pt files are stored.
+    """
+
+    def __init__(self, dataset: torch.utils.data.Dataset, cache_dir: str):
+        cached, self.transform = split_cacheable_transform(
+            dataset.transform, DISK_CACHEABLE_TRANSFORMS
+        )
+        self.dataset = copy.copy(dataset)
+        self.dataset.transform = cached
+        self.classes = dataset.classes
+        # the cache is keyed by the cached transforms, so changing them
+        # does not silently reuse stale tensors
+        digest = hashlib.md5(repr(cached).encode()).hexdigest()[:8]
+        self.cache_dir = f"{cache_dir}_{digest}"
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def __getitem__(self, idx):
+        path = os.path.join(self.cache_dir, f"{idx}.pt")
+        if os.path.exists(path):
+            x, y = torch.load(path)
+        else:
+            x, y = self.dataset[idx]
+            x = x.as_subclass(torch.Tensor)
+            # workers may race on the same index, so write atomically
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            torch.save((x, y), tmp_path)
+            os.replace(tmp_path, path)
+        return self.transform(x), y
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+class CompactSamples:
+    """Read-only stand-in for the (path, target) list of ImageFolder-like datasets.
+    The paths live in one bytes buffer and the targets in one array, so forked
+    dataloader workers read them without touching the refcounts of millions of
+    python objects, which would copy the pages of the list into every worker.
+    Args:
+        samples (list): list of (path, target) tuples.
+    """
+
+    def __init__(self, samples):
+        paths = [os.fsencode(path) for path, _ in samples]
+        self.paths = np.frombuffer(b"".join(paths), dtype=np.uint8)
+        self.offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+        np.cumsum([len(path) for path in paths], out=self.offsets[1:])
+        self.targets = np.array([target for _, target in samples], dtype=np.int64)
+
+    def __getitem__(self, idx):
+        path = self.paths[self.offsets[idx] : self.offsets[idx + 1]].tobytes()
+        return os.fsdecode(path), int(self.targets[idx])
+
+    def __len__(self):
+        return len(self.targets)
+
+
+def compact_sample_index(dataset):
+    # ImageNet keeps the index in samples (and imgs), Imagenette in _samples
+    for attr in ("samples", "_samples"):
+        samples = getattr(dataset, attr, None)
+        if isinstance(samples, list):
+            setattr(dataset, attr, CompactSamples(samples))
+    if hasattr(dataset, "imgs"):
+        dataset.imgs = dataset.samples
+
+
+def _worker_init_fn(worker_id):
+    # workers run in parallel already, intra-op threads would oversubscribe the cpus
+    torch.set_num_threads(1)
+    # a private generator per worker for GaussianISONoise, seeded from the
+    # worker seed so that every worker draws different noise
+    worker_info = torch.utils.data.get_worker_info()
+    noise_generator = torch.Generator()
+    noise_generator.manual_seed(worker_info.seed)
+    worker_info.dataset.noise_generator = noise_generator
+
+
+class GPUCachedTensorDataset(torch.utils.data.Dataset):
+    """Keeps the decoded images of a small dataset in device memory, as uint8 at
+    their native resolution, and runs the rest of the transform on whole batches
+    on the device.
+    Args:
+        dataset (torch.utils.data.Dataset): dataset whose transform is a Compose.
+        device (str): device on which the tensors are stored.
+    """
+
+    def __init__(self, dataset: torch.utils.data.Dataset, device: str):
+        cached, self.transform = split_cacheable_transform(
+            dataset.transform, (torchvision.transforms.v2.ToImage,)
+        )
+        # Compose keeps a plain list, so the buffers are moved one by one
+        for t in self.transform.transforms:
+            t.to(device)
+        self.classes = dataset.classes
+        dataset = copy.copy(dataset)
+        dataset.transform = cached
+        first, _ = dataset[0]
+        # filled on the host and moved in one copy
+        x = torch.empty((len(dataset), *first.shape), dtype=first.dtype)
+        y = torch.empty(len(dataset), dtype=torch.long)
+        for idx in range(len(dataset)):
+            x[idx], y[idx] = dataset[idx]
+        self.x = x.to(device)
+        self.y = y.to(device)
+
+    def transform_batch(self, x):
+        for t in self.transform.transforms:
+            if isinstance(t, torchvision.transforms.v2.RandomHorizontalFlip):
+                # one draw per sample, the transform itself flips the whole batch
+                mask = torch.rand(len(x), device=x.device) < t.p
+                x = torch.where(mask[:, None, None, None], x.flip(-1), x)
+            elif isinstance(t, STOCHASTIC_TRANSFORMS) and not isinstance(
+                t, GaussianISONoise
+            ):
+                x = torch.stack([t(sample) for sample in x])
+            else:
+                x = t(x)
+        return x
+
+    def __getitem__(self, idx):
+        # the transforms may work in-place
+        return self.transform_batch(self.x[idx : idx + 1].clone())[0], self.y[idx]
+
+    def __len__(self):
+        return len(self.y)
+
+
+class GPUCachedDataLoader:
+    """Batches a GPUCachedTensorDataset by gathering on its device, without workers.
+    Args:
+        dataset (GPUCachedTensorDataset): the cached dataset.
+        batch_size (int): number of samples per batch.
+        shuffle (bool): draw a new permutation every epoch.
+    """
+
+    def __init__(self, dataset: GPUCachedTensorDataset, batch_size: int, shuffle: bool):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        device = self.dataset.x.device
+        if self.shuffle:
+            indices = torch.randperm(len(self.dataset), device=device)
+        else:
+            indices = torch.arange(len(self.dataset), device=device)
+        for batch_indices in indices.split(self.batch_size):
+            x = self.dataset.x.index_select(0, batch_indices)
+            y = self.dataset.y.index_select(0, batch_indices)
+            yield self.dataset.transform_batch(x), y
+
+    def __len__(self):
+        return -(-len(self.dataset) // self.batch_size)
 
 
 class RepeatedSequentialSampler(torch.utils.data.Sampler):
@@ -167,16 +515,26 @@ class RepeatedSequentialSampler(torch.utils.data.Sampler):
     """
 
     def __init__(self, datasource: torch.utils.data.Dataset, num_repeats: int):
-        self.sampler = torch.utils.data.SequentialSampler(datasource)
+        self.num_samples = len(datasource)
         self.num_repeats = num_repeats
 
     def __iter__(self):
-        for s in self.sampler:
-            for _ in range(self.num_repeats):
-                yield s
+        # lazy, so the memory does not grow with num_samples * num_repeats, and the
+        # generator only runs once per sample rather than once per index
+        return itertools.chain.from_iterable(
+            itertools.repeat(idx, self.num_repeats) for idx in range(self.num_samples)
+        )
 
     def __len__(self):
-        return len(self.sampler) * self.num_repeats
+        return self.num_samples * self.num_repeats
+
+
+# small enough to be kept entirely in device memory
+GPU_CACHEABLE_DATASETS = (
+    DatasetSwitch.CIFAR10,
+    DatasetSwitch.MNIST,
+    DatasetSwitch.FASHION_MNIST,
+)
 
 
 def get_training_and_test_dataloader(
@@ -188,6 +546,11 @@ def get_training_and_test_dataloader(
     get_only_test=False,
     shuffle=True,
     sampler=None,
+    use_dali=False,
+    cache_deterministic=False,
+    cache_dir=paths.LOCAL_CACHE_DIR,
+    gpu_cache=False,
+    device="cuda",
     **dataset_kwargs,
 ):
 
@@ -201,6 +564,35 @@ def get_training_and_test_dataloader(
         get_only_test=get_only_test,
         **dataset_kwargs,
     )
+    # every prefetched batch holds a pinned host buffer, high prefetch factors
+    # make the pinned memory grow far beyond what is needed to hide the copies
+    # None is the only value DataLoader accepts without workers
+    if prefetch_factor is not None:
+        prefetch_factor = min(prefetch_factor, 4)
+    if gpu_cache and dataset in GPU_CACHEABLE_DATASETS and sampler is None:
+        test_data = GPUCachedTensorDataset(test_data, device)
+        test_dataloader = GPUCachedDataLoader(test_data, batch_size, shuffle=False)
+        input_shape = test_data[0][0].shape
+        num_classes = len(test_data.classes)
+        if get_only_test:
+            return test_dataloader, input_shape, num_classes
+        training_data = GPUCachedTensorDataset(training_data, device)
+        train_dataloader = GPUCachedDataLoader(training_data, batch_size, shuffle)
+        return train_dataloader, test_dataloader, input_shape, num_classes
+    if num_workers > 0:
+        compact_sample_index(test_data)
+        if training_data is not None:
+            compact_sample_index(training_data)
+    if cache_deterministic:
+        cache_prefix = os.path.join(
+            cache_dir, f"{dataset}_{dataset_kwargs['img_size']}"
+        )
+        if is_worth_caching(test_data.transform):
+            test_data = CachedDeterministicDataset(test_data, f"{cache_prefix}_test")
+        if training_data is not None and is_worth_caching(training_data.transform):
+            training_data = CachedDeterministicDataset(
+                training_data, f"{cache_prefix}_train"
+            )
     num_classes = len(test_data.classes)
     input_shape = test_data[0][0].shape
     test_sampler = None if sampler is None else sampler(test_data)
@@ -211,13 +603,38 @@ def get_training_and_test_dataloader(
         batch_size=batch_size,
         num_workers=num_workers,
         prefetch_factor=prefetch_factor,
-        # pin_memory=True,
+        pin_memory=True,
+        persistent_workers=num_workers > 0,
+        worker_init_fn=_worker_init_fn,
         sampler=None if test_sampler is None else test_sampler,
     )
 
     if get_only_test:
         return test_dataloader, input_shape, num_classes
 
+    if use_dali:
+        # use_dali is part of the experiment prefix, a silent fallback to
+        # torchvision would store its run under the DALI checkpoint path
+        if not (
+            dataset == DatasetSwitch.IMAGENET
+            and dataset_kwargs["augmentation"] == AugmentationSwitch.TRAIN
+            and sampler is None
+            and not dataset_kwargs["add_inverse"]
+        ):
+            raise ValueError(
+                "DALI is only supported for ImageNet training without add_inverse"
+            )
+        if not dali_is_available():
+            raise ValueError("use_dali is set but nvidia.dali is not installed")
+        train_dataloader = get_imagenet_dali_dataloader(
+            root_path,
+            dataset_kwargs["img_size"] or 224,
+            batch_size,
+            num_workers,
+            training_data,
+        )
+        return train_dataloader, test_dataloader, input_shape, num_classes
+
     train_sampler = None if sampler is None else sampler(training_data)
 
     train_dataloader = DataLoader(
@@ -226,7 +643,9 @@ def get_training_and_test_dataloader(
         shuffle=shuffle,
         num_workers=num_workers,
         prefetch_factor=prefetch_factor,
-        # pin_memory=True,
+        pin_memory=True,
+        persistent_workers=num_workers > 0,
+        worker_init_fn=_worker_init_fn,
         sampler=None if train_sampler is None else train_sampler,
     )
 
@@ -244,6 +663,97 @@ FASHION_MNIST_STD = (0.5,)
 MNIST_MEAN = (0.5,)
 MNIST_STD = (0.5,)
 
+_MEAN = {
+    DatasetSwitch.IMAGENET: torch.tensor(IMAGENET_MEAN).view(-1, 1, 1),
+    DatasetSwitch.IMAGENETTE: torch.tensor(IMAGENETTE_MEAN).view(-1, 1, 1),
+}
+_INV_STD = {
+    DatasetSwitch.IMAGENET: 1 / torch.tensor(IMAGENET_STD).view(-1, 1, 1),
+    DatasetSwitch.IMAGENETTE: 1 / torch.tensor(IMAGENETTE_STD).view(-1, 1, 1),
+}
+
+
+# built once and shared by the ImageNet and Imagenette training pipelines
+_IMAGENET_TRAIN_CHOICE = torchvision.transforms.v2.RandomChoice(
+    [
+        torchvision.transforms.v2.RandomHorizontalFlip(),
+        torchvision.transforms.v2.RandomVerticalFlip(),
+        torchvision.transforms.v2.ColorJitter(
+            brightness=0.1, contrast=0.1, saturation=0.1, hue=0.1
+        ),
+        torchvision.transforms.v2.RandomRotation(10),
+        torchvision.transforms.v2.RandomAffine(degrees=5, translate=(0.1, 0.1)),
+        torchvision.transforms.v2.RandomPerspective(distortion_scale=0.1),
+        torchvision.transforms.v2.RandomErasing(p=0.25, value="random"),
+        torchvision.transforms.v2.RandomGrayscale(p=0.1),
+    ]
+)
+
+
+# JPEG decoding dominates the cost of the ImageNet/Imagenette loaders. It goes
+# through PIL, so installing pillow-simd in place of pillow speeds it up without
+# any change here.
+def decode_and_resize(resize):
+    """Resizes the decoded uint8 image before converting it to float, so the
+    resize moves 4x fewer bytes than ToTensor followed by Resize.
+    """
+    return [
+        torchvision.transforms.v2.ToImage(),
+        resize,
+        torchvision.transforms.v2.ToDtype(torch.float32, scale=True),
+    ]
+
+
+class FusedNormalize(torch.nn.Module):
+    """Converts a uint8 image to float and normalizes it, with the 1/255 scaling
+    folded into the normalization so that it takes one allocation and no division.
+    Args:
+        mean (tuple): per channel mean of the image scaled to [0, 1]
+        std (tuple): per channel standard deviation of the image scaled to [0, 1]
+    """
+
+    def __init__(self, mean, std):
+        super().__init__()
+        self.mean = tuple(mean)
+        self.std = tuple(std)
+        mean = torch.tensor(mean).view(-1, 1, 1)
+        std = torch.tensor(std).view(-1, 1, 1)
+        self.register_buffer("scale", 1 / (255 * std))
+        self.register_buffer("shift", -mean / std)
+
+    def extra_repr(self) -> str:
+        # part of the key of CachedDeterministicDataset
+        return f"mean={self.mean}, std={self.std}"
+
+    def forward(self, in_tensor: torch.Tensor) -> torch.Tensor:
+        out = in_tensor.as_subclass(torch.Tensor).to(torch.float32)
+        return out.mul_(self.scale).add_(self.shift)
+
+
+class FastNormalize(torch.nn.Module):
+    """Normalizes a float image in-place with precomputed mean and inverse std.
+    Args:
+        mean (torch.Tensor): per channel mean of shape (C, 1, 1)
+        inv_std (torch.Tensor): per channel inverse standard deviation of shape (C, 1, 1)
+    """
+
+    def __init__(self, mean, inv_std):
+        super().__init__()
+        self.register_buffer("mean", mean)
+        self.register_buffer("inv_std", inv_std)
+
+    def forward(self, in_tensor: torch.Tensor) -> torch.Tensor:
+        return in_tensor.as_subclass(torch.Tensor).sub_(self.mean).mul_(self.inv_std)
+
+
+def decode_resize_and_normalize(resize, add_inverse, mean, std):
+    """Same as decode_and_resize followed by Normalize(mean, std), or by AddInverse
+    which needs the image in [0, 1].
+    """
+    if add_inverse:
+        return [*decode_and_resize(resize), AddInverse()]
+    return [torchvision.transforms.v2.ToImage(), resize, FusedNormalize(mean, std)]
+
 
 # see b-cos v2 for this
 # We have added this to do an ablation study
@@ -261,7 +771,15 @@ class AddInverse(torch.nn.Module):
         self.dim = dim
 
     def forward(self, in_tensor: torch.Tensor) -> torch.Tensor:
-        return torch.cat([in_tensor, 1 - in_tensor], dim=self.dim)
+        # write both halves into one buffer instead of materializing 1 - x and
+        # then concatenating
+        C = in_tensor.shape[self.dim]
+        shape = list(in_tensor.shape)
+        shape[self.dim] = 2 * C
+        out = torch.empty(shape, dtype=in_tensor.dtype, device=in_tensor.device)
+        out.narrow(self.dim, 0, C).copy_(in_tensor)
+        torch.sub(1.0, in_tensor, out=out.narrow(self.dim, C, C))
+        return out
 
 
 @register_dataset(DatasetSwitch.IMAGENET)
@@ -367,6 +885,91 @@ def get_imagenet_test(
     return test_data
 
 
+def dali_is_available():
+    try:
+        import nvidia.dali
+    except ImportError:
+        return False
+    return True
+
+
+class DALIDataLoader:
+    """Wraps a DALIGenericIterator so that it yields (x, y) batches like a DataLoader.
+    Args:
+        iterator (DALIGenericIterator): iterator with "data" and "label" outputs.
+        dataset (torch.utils.data.Dataset): the dataset the pipeline reads from.
+    """
+
+    def __init__(self, iterator, dataset):
+        self.iterator = iterator
+        self.dataset = dataset
+
+    def __iter__(self):
+        for batch in self.iterator:
+            yield batch[0]["data"], batch[0]["label"].squeeze(-1).long()
+
+    def __len__(self):
+        return len(self.iterator)
+
+
+def get_imagenet_dali_dataloader(
+    root_path,
+    img_size,
+    batch_size,
+    num_workers,
+    training_data,
+):
+    """Runs decoding and the training augmentations of ImageNet on the GPU with DALI.
+    The random choice of get_aug_imagenet is approximated by a random flip and a
+    color twist. Gaussian noise and blur are left to get_batch_aug.
+    """
+    from nvidia.dali import fn, pipeline_def, types
+    from nvidia.dali.plugin.pytorch import DALIGenericIterator, LastBatchPolicy
+
+    @pipeline_def
+    def imagenet_train_pipeline():
+        # labels follow the sorted class folders, same as torchvision's ImageNet
+        jpegs, labels = fn.readers.file(
+            file_root=os.path.join(root_path, "train"),
+            random_shuffle=True,
+            name="Reader",
+        )
+        images = fn.decoders.image(jpegs, device="mixed", output_type=types.RGB)
+        images = fn.random_resized_crop(images, size=img_size)
+        images = fn.color_twist(
+            images,
+            brightness=fn.random.uniform(range=[0.9, 1.1]),
+            contrast=fn.random.uniform(range=[0.9, 1.1]),
+            saturation=fn.random.uniform(range=[0.9, 1.1]),
+            hue=fn.random.uniform(range=[-36.0, 36.0]),  # in degrees
+        )
+        images = fn.crop_mirror_normalize(
+            images,
+            dtype=types.FLOAT,
+            output_layout="CHW",
+            mean=[255 * m for m in IMAGENET_MEAN],
+            std=[255 * s for s in IMAGENET_STD],
+            mirror=fn.random.coin_flip(),
+        )
+        return images, labels.gpu()
+
+    pipeline = imagenet_train_pipeline(
+        batch_size=batch_size,
+        num_threads=max(num_workers, 1),
+        device_id=torch.cuda.current_device(),
+    )
+    pipeline.build()
+    iterator = DALIGenericIterator(
+        pipeline,
+        ["data", "label"],
+        reader_name="Reader",
+        last_batch_policy=LastBatchPolicy.PARTIAL,
+        auto_reset=True,
+    )
+    return DALIDataLoader(iterator, training_data)
+
+
+@functools.lru_cache(maxsize=None)
 def get_aug_imagenet(
     img_size,
     augmentation,
@@ -378,74 +981,60 @@ def get_aug_imagenet(
     if augmentation == AugmentationSwitch.TRAIN:
         if split == "train":
             augmentations = [
-                torchvision.transforms.ToTensor(),
-                torchvision.transforms.RandomResizedCrop(img_size),
-                torchvision.transforms.RandomChoice(
-                    [
-                        torchvision.transforms.RandomHorizontalFlip(),
-                        torchvision.transforms.RandomVerticalFlip(),
-                        torchvision.transforms.ColorJitter(
-                            brightness=0.1, contrast=0.1, saturation=0.1, hue=0.1
-                        ),
-                        torchvision.transforms.RandomRotation(10),
-                        torchvision.transforms.RandomAffine(
-                            degrees=5, translate=(0.1, 0.1)
-                        ),
-                        torchvision.transforms.RandomPerspective(distortion_scale=0.1),
-                        torchvision.transforms.RandomErasing(p=0.25, value="random"),
-                        torchvision.transforms.RandomGrayscale(p=0.1),
-                    ]
+                *decode_and_resize(
+                    torchvision.transforms.v2.RandomResizedCrop(
+                        img_size, antialias=True
+                    )
                 ),
+                _IMAGENET_TRAIN_CHOICE,
                 # ablation of Bcos
                 (
                     AddInverse()
                     if add_inverse
-                    else torchvision.transforms.Normalize(IMAGENET_MEAN, IMAGENET_STD)
+                    else FastNormalize(
+                        _MEAN[DatasetSwitch.IMAGENET],
+                        _INV_STD[DatasetSwitch.IMAGENET],
+                    )
                 ),
-                GaussianISONoise(gaussian_noise_var),
+                # gaussian noise and blur are applied per batch, see get_batch_aug
             ]
-            if gaussian_blur_var > 0:
-                augmentations.append(
-                    torchvision.transforms.GaussianBlur(5, gaussian_blur_var)
-                )
         elif split == "test":
             augmentations = [
-                torchvision.transforms.ToTensor(),
-                torchvision.transforms.Resize((img_size, img_size)),
-                (
-                    # ablation of Bcos
-                    AddInverse()
-                    if add_inverse
-                    else torchvision.transforms.Normalize(IMAGENET_MEAN, IMAGENET_STD)
+                # ablation of Bcos
+                *decode_resize_and_normalize(
+                    torchvision.transforms.v2.Resize(
+                        (img_size, img_size), antialias=True
+                    ),
+                    add_inverse,
+                    IMAGENET_MEAN,
+                    IMAGENET_STD,
                 ),
             ]
         else:
             raise ValueError(f"Split {split} not recognized")
     elif augmentation == AugmentationSwitch.EXP_GEN:
         augmentations = [
-            torchvision.transforms.ToTensor(),
-            torchvision.transforms.Resize((img_size, img_size)),
-            (
-                # ablation of Bcos
-                AddInverse()
-                if add_inverse
-                else torchvision.transforms.Normalize(IMAGENET_MEAN, IMAGENET_STD)
+            # ablation of Bcos
+            *decode_resize_and_normalize(
+                torchvision.transforms.v2.Resize((img_size, img_size), antialias=True),
+                add_inverse,
+                IMAGENET_MEAN,
+                IMAGENET_STD,
             ),
         ]
         if gaussian_noise_var > 0:
             augmentations.append(GaussianISONoise(gaussian_noise_var))
         if gaussian_blur_var > 0:
-            augmentations.append(
-                torchvision.transforms.GaussianBlur(5, gaussian_blur_var)
-            )
+            augmentations.append(SeparableGaussianBlur(5, gaussian_blur_var))
     if augmentation == AugmentationSwitch.EXP_VIS:
         augmentations = (
-            torchvision.transforms.ToTensor(),
-            torchvision.transforms.Resize((img_size, img_size)),
+            *decode_and_resize(
+                torchvision.transforms.v2.Resize((img_size, img_size), antialias=True)
+            ),
         )
 
     assert len(augmentations) > 0, "Augmentations list is empty"
-    augmentations = torchvision.transforms.Compose(augmentations)
+    augmentations = torchvision.transforms.v2.Compose(augmentations)
     return augmentations
 
 
@@ -516,6 +1105,7 @@ def get_imagenette_train(
     return training_data
 
 
+@functools.lru_cache(maxsize=None)
 def get_aug_imagenette(
     img_size,
     augmentation,
@@ -527,49 +1117,33 @@ def get_aug_imagenette(
     if augmentation == AugmentationSwitch.TRAIN:
         if split == "train":
             augmentations = [
-                torchvision.transforms.ToTensor(),
-                torchvision.transforms.RandomResizedCrop(img_size),
-                torchvision.transforms.RandomChoice(
-                    [
-                        torchvision.transforms.RandomHorizontalFlip(),
-                        torchvision.transforms.RandomVerticalFlip(),
-                        torchvision.transforms.ColorJitter(
-                            brightness=0.1, contrast=0.1, saturation=0.1, hue=0.1
-                        ),
-                        torchvision.transforms.RandomRotation(10),
-                        torchvision.transforms.RandomAffine(
-                            degrees=5, translate=(0.1, 0.1)
-                        ),
-                        torchvision.transforms.RandomPerspective(distortion_scale=0.1),
-                        torchvision.transforms.RandomErasing(p=0.25, value="random"),
-                        torchvision.transforms.RandomGrayscale(p=0.1),
-                    ]
+                *decode_and_resize(
+                    torchvision.transforms.v2.RandomResizedCrop(
+                        img_size, antialias=True
+                    )
                 ),
+                _IMAGENET_TRAIN_CHOICE,
                 # ablation of Bcos
                 (
                     AddInverse()
                     if add_inverse
-                    else torchvision.transforms.Normalize(
-                        IMAGENETTE_MEAN, IMAGENETTE_STD
+                    else FastNormalize(
+                        _MEAN[DatasetSwitch.IMAGENETTE],
+                        _INV_STD[DatasetSwitch.IMAGENETTE],
                     )
                 ),
-                GaussianISONoise(gaussian_noise_var),
+                # gaussian noise and blur are applied per batch, see get_batch_aug
             ]
-            if gaussian_blur_var > 0:
-                augmentations.append(
-                    torchvision.transforms.GaussianBlur(5, gaussian_blur_var)
-                )
         elif split == "test":
             augmentations = [
-                torchvision.transforms.ToTensor(),
-                torchvision.transforms.Resize((img_size, img_size)),
-                (
-                    # ablation of Bcos
-                    AddInverse()
-                    if add_inverse
-                    else torchvision.transforms.Normalize(
-                        IMAGENETTE_MEAN, IMAGENETTE_STD
-                    )
+                # ablation of Bcos
+                *decode_resize_and_normalize(
+                    torchvision.transforms.v2.Resize(
+                        (img_size, img_size), antialias=True
+                    ),
+                    add_inverse,
+                    IMAGENETTE_MEAN,
+                    IMAGENETTE_STD,
                 ),
             ]
         else:
@@ -577,26 +1151,24 @@ def get_aug_imagenette(
 
     elif augmentation == AugmentationSwitch.EXP_GEN:
         augmentations = [
-            torchvision.transforms.ToTensor(),
-            torchvision.transforms.Resize((img_size, img_size)),
-            (
-                # ablation of Bcos
-                AddInverse()
-                if add_inverse
-                else torchvision.transforms.Normalize(IMAGENETTE_MEAN, IMAGENETTE_STD)
+            # ablation of Bcos
+            *decode_resize_and_normalize(
+                torchvision.transforms.v2.Resize((img_size, img_size), antialias=True),
+                add_inverse,
+                IMAGENETTE_MEAN,
+                IMAGENETTE_STD,
             ),
             GaussianISONoise(gaussian_noise_var),
         ]
         if gaussian_blur_var > 0:
-            augmentations.append(
-                torchvision.transforms.GaussianBlur(5, gaussian_blur_var)
-            )
+            augmentations.append(SeparableGaussianBlur(5, gaussian_blur_var))
     if augmentation == AugmentationSwitch.EXP_VIS:
         augmentations = (
-            torchvision.transforms.ToTensor(),
-            torchvision.transforms.Resize((img_size, img_size)),
+            *decode_and_resize(
+                torchvision.transforms.v2.Resize((img_size, img_size), antialias=True)
+            ),
         )
-    augmentations = torchvision.transforms.Compose(augmentations)
+    augmentations = torchvision.transforms.v2.Compose(augmentations)
     return augmentations
 
 
@@ -674,6 +1246,7 @@ def get_fashion_mnist_dataset(
     return training_data, test_data
 
 
+@functools.lru_cache(maxsize=None)
 def get_aug_fmnist(
     img_size,
     add_inverse,
@@ -683,26 +1256,25 @@ def get_aug_fmnist(
 ):
     if augmentation == AugmentationSwitch.EXP_VIS:
         test_transform = [
-            torchvision.transforms.ToTensor(),
-            torchvision.transforms.Resize((img_size, img_size)),
+            *decode_and_resize(
+                torchvision.transforms.v2.Resize((img_size, img_size), antialias=True)
+            ),
         ]
         train_transform = test_transform.copy()
         if add_inverse:
             raise NotImplementedError("AddInverse not implemented for FashionMNIST")
     else:
         test_transform = [
-            torchvision.transforms.ToTensor(),
-            torchvision.transforms.Normalize(FASHION_MNIST_MEAN, FASHION_MNIST_STD),
-            torchvision.transforms.Resize((img_size, img_size)),
+            *decode_resize_and_normalize(
+                torchvision.transforms.v2.Resize((img_size, img_size), antialias=True),
+                False,
+                FASHION_MNIST_MEAN,
+                FASHION_MNIST_STD,
+            ),
         ]
         train_transform: list = test_transform.copy()
         if augmentation == AugmentationSwitch.TRAIN:
-            if gaussian_noise_var > 0:
-                train_transform.append(GaussianISONoise(gaussian_noise_var))
-            if gaussian_blur_var > 0:
-                train_transform.append(
-                    torchvision.transforms.GaussianBlur(5, gaussian_blur_var)
-                )
+            # gaussian noise and blur are applied per batch, see get_batch_aug
             if add_inverse:
                 raise NotImplementedError("AddInverse not implemented for FashionMNIST")
         elif augmentation == AugmentationSwitch.EXP_GEN:
@@ -710,15 +1282,11 @@ def get_aug_fmnist(
                 train_transform.append(GaussianISONoise(gaussian_noise_var))
                 test_transform.append(GaussianISONoise(gaussian_noise_var))
             if gaussian_blur_var > 0:
-                train_transform.append(
-                    torchvision.transforms.GaussianBlur(5, gaussian_blur_var)
-                )
-                test_transform.append(
-                    torchvision.transforms.GaussianBlur(5, gaussian_blur_var)
-                )
-
-    test_transform = torchvision.transforms.Compose(test_transform)
-    train_transform = torchvision.transforms.Compose(train_transform)
+                train_transform.append(SeparableGaussianBlur(5, gaussian_blur_var))
+                test_transform.append(SeparableGaussianBlur(5, gaussian_blur_var))
+
+    test_transform = torchvision.transforms.v2.Compose(test_transform)
+    train_transform = torchvision.transforms.v2.Compose(train_transform)
     return test_transform, train_transform
 
 
@@ -760,6 +1328,7 @@ def get_cifar10_dataset(
     return training_data, test_data
 
 
+@functools.lru_cache(maxsize=None)
 def get_aug_cifar10(
     img_size,
     add_inverse,
@@ -769,49 +1338,41 @@ def get_aug_cifar10(
 ):
     if augmentation == AugmentationSwitch.EXP_VIS:
         test_transform = [
-            torchvision.transforms.ToTensor(),
-            torchvision.transforms.Resize((img_size, img_size)),
+            *decode_and_resize(
+                torchvision.transforms.v2.Resize((img_size, img_size), antialias=True)
+            ),
         ]
         train_transform = test_transform.copy()
         if add_inverse:
             raise NotImplementedError("AddInverse not implemented for CIFAR10")
     else:
         test_transform = [
-            torchvision.transforms.ToTensor(),
-            torchvision.transforms.Resize((img_size, img_size)),
-            (
-                AddInverse()
-                if add_inverse
-                else torchvision.transforms.Normalize(CIFAR10_MEAN, CIFAR10_STD)
+            *decode_resize_and_normalize(
+                torchvision.transforms.v2.Resize((img_size, img_size), antialias=True),
+                add_inverse,
+                CIFAR10_MEAN,
+                CIFAR10_STD,
             ),
         ]
         train_transform = test_transform.copy()
         if augmentation == AugmentationSwitch.TRAIN:
             train_transform.append(
-                torchvision.transforms.RandomHorizontalFlip(),
+                torchvision.transforms.v2.RandomHorizontalFlip(),
             )
-            if gaussian_noise_var > 0:
-                train_transform.append(GaussianISONoise(gaussian_noise_var))
-            if gaussian_blur_var > 0:
-                train_transform.append(
-                    torchvision.transforms.GaussianBlur(5, gaussian_blur_var)
-                )
+            # gaussian noise and blur are applied per batch, see get_batch_aug
         elif augmentation == AugmentationSwitch.EXP_GEN:
             if gaussian_noise_var > 0:
                 train_transform.append(GaussianISONoise(gaussian_noise_var))
                 test_transform.append(GaussianISONoise(gaussian_noise_var))
             if gaussian_blur_var > 0:
-                train_transform.append(
-                    torchvision.transforms.GaussianBlur(5, gaussian_blur_var)
-                )
-                test_transform.append(
-                    torchvision.transforms.GaussianBlur(5, gaussian_blur_var)
-                )
-    train_transform = torchvision.transforms.Compose(train_transform)
-    test_transform = torchvision.transforms.Compose(test_transform)
+                train_transform.append(SeparableGaussianBlur(5, gaussian_blur_var))
+                test_transform.append(SeparableGaussianBlur(5, gaussian_blur_var))
+    train_transform = torchvision.transforms.v2.Compose(train_transform)
+    test_transform = torchvision.transforms.v2.Compose(test_transform)
     return train_transform, test_transform
 
 
+@functools.lru_cache(maxsize=None)
 def get_aug_mnist(
     img_size,
     add_inverse,
@@ -821,39 +1382,34 @@ def get_aug_mnist(
 ):
     if augmentation == AugmentationSwitch.EXP_VIS:
         test_transform = [
-            torchvision.transforms.ToTensor(),
-            torchvision.transforms.Resize((img_size, img_size)),
+            *decode_and_resize(
+                torchvision.transforms.v2.Resize((img_size, img_size), antialias=True)
+            ),
         ]
         train_transform = test_transform.copy()
         if add_inverse:
             raise NotImplementedError("AddInverse not implemented for MNIST")
     else:
         test_transform = [
-            torchvision.transforms.ToTensor(),
-            torchvision.transforms.Resize((img_size, img_size)),
-            (
-                AddInverse()
-                if add_inverse
-                else torchvision.transforms.Normalize(MNIST_MEAN, MNIST_STD)
+            *decode_resize_and_normalize(
+                torchvision.transforms.v2.Resize((img_size, img_size), antialias=True),
+                add_inverse,
+                MNIST_MEAN,
+                MNIST_STD,
             ),
         ]
         train_transform = test_transform.copy()
-        if gaussian_noise_var > 0:
-            train_transform.append(GaussianISONoise(gaussian_noise_var))
-            if augmentation == AugmentationSwitch.EXP_GEN:
+        # for training, gaussian noise and blur are applied per batch, see get_batch_aug
+        if augmentation == AugmentationSwitch.EXP_GEN:
+            if gaussian_noise_var > 0:
+                train_transform.append(GaussianISONoise(gaussian_noise_var))
                 test_transform.append(GaussianISONoise(gaussian_noise_var))
+            if gaussian_blur_var > 0:
+                train_transform.append(SeparableGaussianBlur(5, gaussian_blur_var))
+                test_transform.append(SeparableGaussianBlur(5, gaussian_blur_var))
 
-        if gaussian_blur_var > 0:
-            train_transform.append(
-                torchvision.transforms.GaussianBlur(5, gaussian_blur_var)
-            )
-            if augmentation == AugmentationSwitch.EXP_GEN:
-                test_transform.append(
-                    torchvision.transforms.GaussianBlur(5, gaussian_blur_var)
-                )
-
-    train_transform = torchvision.transforms.Compose(train_transform)
-    test_transform = torchvision.transforms.Compose(test_transform)
+    train_transform = torchvision.transforms.v2.Compose(train_transform)
+    test_transform = torchvision.transforms.v2.Compose(test_transform)
     return train_transform, test_transform
 
 
@@ -899,17 +1455,78 @@ def get_mnist_dataset(
     return training_data, test_data
 
 
+def iter_pt_files(root_path):
+    # only reads directory entries, unlike glob which stats every file
+    with os.scandir(root_path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_pt_files(entry.path)
+            elif entry.name.endswith(".pt"):
+                yield entry.path
+
+
 class GradsDataset(torch.utils.data.Dataset):
-    def __init__(self, root_path):
+    """Gradient statistics saved by compute_grad, one .pt file per image.
+    Args:
+        root_path (str): directory that is searched recursively for .pt files.
+        mmap (bool): memory-map the tensors instead of copying them into memory.
+    """
+
+    def __init__(self, root_path, mmap=True):
         self.root_path = root_path
-        self.files = glob(
-            os.path.join(root_path, "**/*.pt"),
-            recursive=True,
-        )
+        self.mmap = mmap
+        self.files = list(iter_pt_files(root_path))
 
     def __getitem__(self, idx):
         file_path = self.files[idx]
-        data = torch.load(file_path)
+        # the stats also hold numpy arrays, hence weights_only=False
+        data = torch.load(file_path, mmap=self.mmap, weights_only=False)
+        data["address"] = file_path
+        return data
+
+    def __len__(self):
+        return len(self.files)
+
+
+def read_file(file_path):
+    with open(file_path, "rb", buffering=0) as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        return f.read()
+
+
+class PrefetchedGradsDataset(torch.utils.data.IterableDataset):
+    """Streams the same samples as GradsDataset, but each worker keeps up to
+    read_ahead file reads in flight so that the latency of small reads overlaps.
+    Args:
+        root_path (str): directory that is searched recursively for .pt files.
+        read_ahead (int): number of concurrent reads per dataloader worker.
+    """
+
+    def __init__(self, root_path, read_ahead=32):
+        self.root_path = root_path
+        self.read_ahead = read_ahead
+        self.files = list(iter_pt_files(root_path))
+
+    def __iter__(self):
+        files = self.files
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is not None:
+            files = files[worker_info.id :: worker_info.num_workers]
+
+        with ThreadPoolExecutor(max_workers=self.read_ahead) as executor:
+            pending = deque()
+            for file_path in files:
+                pending.append((file_path, executor.submit(read_file, file_path)))
+                if len(pending) >= self.read_ahead:
+                    yield self._load(*pending.popleft())
+            while pending:
+                yield self._load(*pending.popleft())
+
+    @staticmethod
+    def _load(file_path, future):
+        # the stats also hold numpy arrays, hence weights_only=False
+        data = torch.load(io.BytesIO(future.result()), weights_only=False)
         data["address"] = file_path
         return data
 
@@ -917,9 +1534,87 @@ class GradsDataset(torch.utils.data.Dataset):
         return len(self.files)
 
 
+GRADS_SHARDS_PATTERN = "grads-%06d.tar"
+GRADS_SHARDS_INDEX = "grads-shards.json"
+
+
+def grads_shards_dir(root_path):
+    # next to root_path rather than inside it, so syncing root_path does not
+    # stage the .pt files and the shards twice
+    return os.path.normpath(root_path) + "-shards"
+
+
+def pack_grads_to_shards(root_path, output_dir=None, shard_size_gb=2):
+    """Packs the .pt files under root_path into tar shards of about shard_size_gb,
+    which get_grad_dataloader streams instead of opening every file. The number of
+    samples is stored next to the shards since webdataset does not know it.
+    """
+    import webdataset as wds
+
+    output_dir = grads_shards_dir(root_path) if output_dir is None else output_dir
+    os.makedirs(output_dir, exist_ok=True)
+    num_samples = 0
+    with wds.ShardWriter(
+        os.path.join(output_dir, GRADS_SHARDS_PATTERN),
+        maxsize=int(shard_size_gb * 1e9),
+    ) as sink:
+        for file_path in iter_pt_files(root_path):
+            key = os.path.splitext(os.path.relpath(file_path, root_path))[0]
+            sink.write({"__key__": key, "pt": read_file(file_path)})
+            num_samples += 1
+
+    with open(os.path.join(output_dir, GRADS_SHARDS_INDEX), "w") as f:
+        json.dump({"num_samples": num_samples}, f)
+
+
+def decode_grads_sample(sample, root_path):
+    # the stats also hold numpy arrays, hence weights_only=False
+    data = torch.load(io.BytesIO(sample["pt"]), weights_only=False)
+    # the address of the file before packing, so downstream parsing is unchanged
+    data["address"] = os.path.join(root_path, sample["__key__"] + ".pt")
+    # the original file, so it can be written back out without re-serializing
+    data["raw"] = sample["pt"]
+    return data
+
+
+def find_grads_shards(root_path):
+    """Returns the directory holding the shards of root_path and the shards in it,
+    or (None, []) when root_path has not been packed.
+    """
+    for shards_dir in (grads_shards_dir(root_path), root_path):
+        shards = sorted(glob(os.path.join(shards_dir, "grads-*.tar")))
+        if shards:
+            return shards_dir, shards
+    return None, []
+
+
+def get_grads_shards_dataset(root_path, shards_dir, shards):
+    import webdataset as wds
+
+    with open(os.path.join(shards_dir, GRADS_SHARDS_INDEX)) as f:
+        num_samples = json.load(f)["num_samples"]
+
+    # shards are split between the dataloader workers
+    return (
+        wds.WebDataset(shards, shardshuffle=False)
+        .map(functools.partial(decode_grads_sample, root_path=root_path))
+        .with_length(num_samples)
+    )
+
+
 @register_dataset(DatasetSwitch.GRADS)
-def get_grad_dataloader(root_path, num_workers, prefetch_factor):
-    data = GradsDataset(root_path)
+def get_grad_dataloader(root_path, num_workers, prefetch_factor, read_ahead=0):
+    shards_dir, shards = find_grads_shards(root_path)
+    if shards:
+        data = get_grads_shards_dataset(root_path, shards_dir, shards)
+        # shards are not split further, a worker without a shard would raise
+        num_workers = min(num_workers, len(shards))
+        if num_workers == 0:
+            prefetch_factor = None
+    elif read_ahead > 0:
+        data = PrefetchedGradsDataset(root_path, read_ahead)
+    else:
+        data = GradsDataset(root_path)
     dataloader = DataLoader(
         data,
         batch_size=1,
@@ -928,3 +1623,8 @@ def get_grad_dataloader(root_path, num_workers, prefetch_factor):
         prefetch_factor=prefetch_factor,
     )
     return dataloader
+
+
+# read-only views, all datasets are registered at import time above
+registered_datasets = types.MappingProxyType(_registered_datasets)
+registered_dataset_roots = types.MappingProxyType(_registered_dataset_roots)
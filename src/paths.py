@@ -1,3 +1,5 @@
+import os
+
 WORKDIR = "/home/x_amime/x_amime/projects/kernel-view-to-explainability"
 DATASETS_COMMON = "/proj/azizpour-group/datasets"
 
@@ -13,6 +15,10 @@ CHECKPOINTS_DIR = f"{WORKDIR}/checkpoints/"
 COMPUTE_OUTPUT_DIR = "/scratch/local/outputs/"
 LOCAL_OUTPUT_DIR = f"{WORKDIR}/.tmp/outputs/"
 LOCAL_QUANTS_DIR = f"{WORKDIR}/.tmp/quants/"
+LOCAL_CACHE_DIR = f"{WORKDIR}/.tmp/cache/"
+COMPUTE_CACHE_DIR = "/scratch/local/cache/"
+# install prefix of fpart/fpsync, `module load Fpart` exports it as EBROOTFPART
+FPART_ROOT = os.environ.get("FPART_ROOT", os.environ.get("EBROOTFPART"))
 
 
 def get_local_data_dir(dataset):
@@ -66,6 +66,7 @@ def main(
     prefetch_factor,
     hook_samples,
     output_dir,
+    read_ahead=0,
     **kwargs,
 ):
     print(f"num_workers: {num_workers}")
@@ -85,6 +86,7 @@ def main(
         root_path,
         num_workers=num_workers,
         prefetch_factor=prefetch_factor,
+        read_ahead=read_ahead,
     )
     measurements = []
     print(f"len(dataloader): {len(dataloader)}")
@@ -98,8 +100,17 @@ def main(
         if data["index"] in hook_samples:
             address = data["address"][0]
             parent_dir = os.path.basename(os.path.dirname(address))
-            os.system(f"rsync -a {address} {hooks_dir}/{parent_dir}/")  # faster
-            # torch.save(data, f"{hooks_dir}/{data['address']}") # slower
+            if os.path.exists(address):
+                os.system(f"rsync -a {address} {hooks_dir}/{parent_dir}/")  # faster
+            else:
+                # streamed from packed shards, there is no file to copy
+                os.makedirs(os.path.join(hooks_dir, parent_dir), exist_ok=True)
+                # write the packed file as is, data only holds the collated batch
+                hook_file = os.path.join(
+                    hooks_dir, parent_dir, os.path.basename(address)
+                )
+                with open(hook_file, "wb") as f:
+                    f.write(data["raw"][0])
 
         if ((i > 0) and (i % q10_dataloader == 0)) or (i == len(dataloader) - 1):
             print(f"{i / len(dataloader):.2%} is processed")
@@ -109,5 +120,7 @@ def main(
                 output_dir, f"{name}{EXPERIMENT_PREFIX_SEP}_{i}_quants.pt"
             )
 
-            torch.save(measurements, file_name)
+            # the measurements are mostly numpy arrays, which protocol 5 pickles
+            # from their buffers instead of through an intermediate bytes copy
+            torch.save(measurements, file_name, pickle_protocol=5)
             measurements = []
@@ -2,8 +2,9 @@ import argparse
 import torch
 from datetime import datetime
 
+from src import paths
 from src.models.utils import get_model
-from src.datasets import get_training_and_test_dataloader
+from src.datasets import get_batch_aug, get_training_and_test_dataloader
 from src.utils import (
     ActivationSwitch,
     AugmentationSwitch,
@@ -14,6 +15,7 @@ from src.utils import (
     convert_str_to_loss_fn,
     save_pth,
     get_save_path,
+    wait_for_saves,
 )
 
 
@@ -96,6 +98,21 @@ def get_inputs():
         action="store_true",
         help="add the inverse of the input image to the input",
     )
+    parser.add_argument(
+        "--use_dali",
+        action="store_true",
+        help="use DALI for the ImageNet training pipeline, stored under its own checkpoint path",
+    )
+    parser.add_argument(
+        "--cache_deterministic",
+        action="store_true",
+        help="cache the deterministic part of the preprocessing on disk",
+    )
+    parser.add_argument(
+        "--gpu_cache",
+        action="store_true",
+        help="keep small datasets (CIFAR10, MNIST, FashionMNIST) in device memory",
+    )
     parser.add_argument(
         "--num_workers",
         type=int,
@@ -180,13 +197,14 @@ def get_inputs():
     return args
 
 
-def train(dataloader, model, loss_fn, optimizer, epoch, device, writer):
+def train(dataloader, model, loss_fn, optimizer, epoch, device, writer, batch_aug):
     model.train()
     size = len(dataloader.dataset)
     total_loss, total_correct, grad_norm = 0, 0, 0
     for step, (x, y) in enumerate(dataloader):
         optimizer.zero_grad()
-        x, y = x.to(device), y.to(device)
+        x, y = x.to(device, non_blocking=True), y.to(device, non_blocking=True)
+        x = batch_aug(x)
         pred = model(x)
 
         loss = loss_fn(pred, y)
@@ -233,7 +251,7 @@ def test(dataloader, model, loss_fn, epoch, device, writer):
 
     with torch.no_grad():
         for x, y in dataloader:
-            x, y = x.to(device), y.to(device)
+            x, y = x.to(device, non_blocking=True), y.to(device, non_blocking=True)
             pred = model(x)
 
             total_loss += loss_fn(pred, y).item()
@@ -278,6 +296,9 @@ def main(
     device,
     min_test_acc,
     checkpoint_path,
+    use_dali=False,
+    cache_deterministic=False,
+    gpu_cache=False,
     **kwargs,
 ):
     torch.manual_seed(seed)
@@ -297,8 +318,23 @@ def main(
             prefetch_factor=prefetch_factor,
             gaussian_noise_var=gaussian_noise_var,
             gaussian_blur_var=gaussian_blur_var,
+            use_dali=use_dali,
+            cache_deterministic=cache_deterministic,
+            # node-local like the staged data, the cache is read every epoch
+            cache_dir=(
+                paths.LOCAL_CACHE_DIR
+                if kwargs.get("port") == 0
+                else paths.COMPUTE_CACHE_DIR
+            ),
+            gpu_cache=gpu_cache,
+            device=device,
         )
     )
+    batch_aug = get_batch_aug(
+        AugmentationSwitch.TRAIN,
+        gaussian_noise_var,
+        gaussian_blur_var,
+    ).to(device)
 
     # MODEL
     torch.cuda.empty_cache()
@@ -335,6 +371,7 @@ def main(
             epoch,
             device,
             writer,
+            batch_aug,
         )
         test_loss, test_acc = test(
             test_dataloader,
@@ -386,6 +423,7 @@ def main(
             patience_counter = patience
         old_test_acc = test_acc
 
+    wait_for_saves()
     if not saved_any_checkpoint:
         print(
             "No checkpoints saved for ",
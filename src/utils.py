@@ -1,15 +1,23 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
+import functools
 import os
 
+import pandas as pd
 import torch
 from torch import nn
 
 from src import paths
 
 
+@functools.lru_cache(maxsize=1)
+def _cuda_available():
+    return torch.cuda.is_available()
+
+
 def determine_device(args):
-    device = "cuda" if torch.cuda.is_available() else "cpu"
+    device = "cuda" if _cuda_available() else "cpu"
     device = "cpu" if args["port"] == 0 else device
     args["device"] = device
     print(f"Using {device} device")
@@ -25,8 +33,12 @@ class ConvertableEnum(Enum):
                 f"Invalid {cls.__name__} value '{value}'. Choose from {', '.join([e.name for e in cls])}."
             )
 
+    def __init__(self, *args):
+        # str() is used to build paths and look up tables, skip the name property
+        self._name_str = self.name
+
     def __str__(self):
-        return self.name
+        return self._name_str
 
 
 class LossSwitch(ConvertableEnum):
@@ -102,6 +114,61 @@ class AugmentationSwitch(ConvertableEnum):
 EXPERIMENT_PREFIX_SEP = "::"
 
 
+@functools.lru_cache(maxsize=None)
+def _layers_str(layers):
+    # sweeps repeat the same few layer configurations over many rows
+    return "_".join(map(str, layers))
+
+
+def _experiment_prefix(
+    dataset,
+    img_size,
+    model_name,
+    layers,
+    activation,
+    seed,
+    l2_reg,
+    gaussian_noise_var,
+    gaussian_blur_var,
+    lr,
+    use_dali=False,
+):
+    # shared by get_experiment_prefix and get_experiment_prefix_vec
+    name_list = (
+        # dataset,
+        str(model_name),
+        _layers_str(tuple(layers)),
+        str(activation),
+        str(seed),
+        str(l2_reg),
+        str(gaussian_noise_var),
+        str(gaussian_blur_var),
+        str(lr),
+    )
+    # the DALI pipeline augments differently, its runs must not share checkpoints
+    # with the torchvision ones. Kept out of name_list so its fields stay the same
+    dataset_dir = f"{dataset}_DALI" if use_dali else str(dataset)
+    return os.path.join(
+        dataset_dir,
+        str(img_size),
+        EXPERIMENT_PREFIX_SEP.join(name_list),
+    )
+
+
+_EXPERIMENT_PREFIX_FIELDS = (
+    "dataset",
+    "img_size",
+    "model_name",
+    "layers",
+    "activation",
+    "seed",
+    "l2_reg",
+    "gaussian_noise_var",
+    "gaussian_blur_var",
+    "lr",
+)
+
+
 def get_experiment_prefix(
     *,
     dataset,
@@ -114,22 +181,33 @@ def get_experiment_prefix(
     lr,
     gaussian_noise_var,
     gaussian_blur_var,
+    use_dali=False,
     **args,
 ):
-    name_list = []
-    # name_list.append(dataset)
-    name_list.append(model_name)
-    name_list.append("_".join(map(str, layers)))
-    name_list.append(activation)
-    name_list.append(seed)
-    name_list.append(l2_reg)
-    name_list.append(gaussian_noise_var)
-    name_list.append(gaussian_blur_var)
-    name_list.append(lr)
-    return os.path.join(
-        str(dataset),
-        str(img_size),
-        EXPERIMENT_PREFIX_SEP.join(map(str, name_list)),
+    return _experiment_prefix(
+        dataset,
+        img_size,
+        model_name,
+        layers,
+        activation,
+        seed,
+        l2_reg,
+        gaussian_noise_var,
+        gaussian_blur_var,
+        lr,
+        use_dali,
+    )
+
+
+def get_experiment_prefix_vec(df):
+    """Same as get_experiment_prefix for every row of a DataFrame, mapped over
+    the needed columns instead of building a dict per row.
+    """
+    columns = [df[name] for name in _EXPERIMENT_PREFIX_FIELDS]
+    # optional axis of the sweeps, only training sweeps may set it
+    columns.append(df["use_dali"] if "use_dali" in df else [False] * len(df))
+    return pd.Series(
+        list(map(_experiment_prefix, *columns)), index=df.index, dtype=object
     )
 
 
@@ -144,53 +222,97 @@ def get_save_path(
     return path + ".pt"
 
 
+def get_save_path_vec(df):
+    """Same as get_save_path for every row of a DataFrame."""
+    return (
+        os.path.join(paths.CHECKPOINTS_DIR, "") + get_experiment_prefix_vec(df) + ".pt"
+    )
+
+
+# a single worker keeps the checkpoints of one process written in order
+_SAVE_POOL = ThreadPoolExecutor(max_workers=1)
+_pending_saves = []
+
+
+def _save_atomic(obj, path):
+    # a crash while writing leaves the previous checkpoint intact
+    tmp_path = f"{path}.tmp"
+    torch.save(obj, tmp_path, pickle_protocol=5)
+    os.replace(tmp_path, path)
+
+
 def save_pth(
     model,
     train_acc,
     test_acc,
     path,
 ):
-    """Saves the model to a .pt file.
+    """Saves the model to a .pt file in a background thread, so training
+    continues while the checkpoint is written. See wait_for_saves.
 
     Args:
       model: The model to save.
       path: The path to save the model to.
     """
-    torch.save(
-        {
-            "model": model.state_dict(),
-            "train_acc": train_acc,
-            "test_acc": test_acc,
-        },
-        path,
+    # copied now, the optimizer keeps updating the parameters in the meantime
+    state_dict = {
+        k: v.detach().to("cpu", copy=True) for k, v in model.state_dict().items()
+    }
+    _pending_saves.append(
+        _SAVE_POOL.submit(
+            _save_atomic,
+            {
+                "model": state_dict,
+                "train_acc": train_acc,
+                "test_acc": test_acc,
+            },
+            path,
+        )
     )
 
 
-def convert_str_to_activation_fn(activation):
-    str_activation = str(activation)
+def wait_for_saves():
+    """Blocks until all checkpoints passed to save_pth are written, and raises
+    the error of a failed save."""
+    while _pending_saves:
+        _pending_saves.pop(0).result()
 
+
+def _activation_factory(str_activation):
     if "LEAKY_RELU" in str_activation:
-        return nn.LeakyReLU()
+        return nn.LeakyReLU
 
     if "RELU" in str_activation:
-        return nn.ReLU()
+        return nn.ReLU
 
     if "SIGMOID" in str_activation:
-        return nn.Sigmoid()
+        return nn.Sigmoid
 
     if "TANH" in str_activation:
-        return nn.Tanh()
+        return nn.Tanh
 
     if "SOFTPLUS" in str_activation:
         beta = str_activation.replace("SOFTPLUS_B", "")
         beta = beta.replace("_", ".")
         beta = float(beta)
 
-        return nn.Softplus(beta)
+        return functools.partial(nn.Softplus, beta)
 
     raise NameError(str_activation)
 
 
+# names are parsed once, a new module is still created per call
+_ACT_TABLE = {str(a): _activation_factory(str(a)) for a in ActivationSwitch}
+
+
+def convert_str_to_activation_fn(activation):
+    str_activation = str(activation)
+    factory = _ACT_TABLE.get(str_activation)
+    if factory is None:
+        factory = _activation_factory(str_activation)
+    return factory()
+
+
 def convert_str_to_explainer(explainer, model, model_name):
     from captum import attr
 
@@ -223,11 +345,13 @@ def convert_str_to_explainer(explainer, model, model_name):
     raise NameError(explainer)
 
 
-def convert_str_to_loss_fn(loss):
-    if LossSwitch.MSE == loss:
-        return nn.MSELoss(reduction="sum")
+_LOSS_TABLE = {
+    LossSwitch.MSE: functools.partial(nn.MSELoss, reduction="sum"),
+    LossSwitch.CE: functools.partial(nn.CrossEntropyLoss, reduction="sum"),
+}
 
-    if LossSwitch.CE == loss:
-        return nn.CrossEntropyLoss(reduction="sum")
 
-    raise NameError(loss)
+def convert_str_to_loss_fn(loss):
+    if loss not in _LOSS_TABLE:
+        raise NameError(loss)
+    return _LOSS_TABLE[loss]()
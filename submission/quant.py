@@ -12,6 +12,7 @@ sys.path.insert(0, workspace_dir)
 
 from src import paths
 from src.datasets import (
+    add_fpart_to_env,
     extract_the_dataset_on_compute_node,
     move_data_to_compute_node,
     resolve_data_directories,
@@ -23,9 +24,9 @@ from src import quant_measures_grads
 def extract_the_grads_dataset_on_compute_node(COMPUTE_DATA_DIR, EXT, TARGET_DIR):
     extract_the_dataset_on_compute_node(COMPUTE_DATA_DIR, EXT, TARGET_DIR)
 
-    # extract the sub directories
+    # extract the sub directories, the packed grads shards are streamed as they are
     os.system(
-        f'find {TARGET_DIR}*/ -type f -name "*.tar" | xargs -I @ -P 16 sh -c \'tar -xf @ -C "$(dirname @)"\''
+        f'find {TARGET_DIR}*/ -type f -name "*.tar" ! -name "grads-*.tar" | xargs -I @ -P 16 sh -c \'tar -xf @ -C "$(dirname @)"\''
     )
 
 
@@ -52,7 +53,7 @@ def main(args):
         LOCAL_OUTPUT_DIR,
     ) = resolve_data_directories(args)
 
-    os.system("module load Fpart/1.5.1-gcc-8.5.0")
+    add_fpart_to_env()
     DATA_DIR = os.path.join(DATA_DIR, args["name"])
     move_data_to_compute_node(DATA_DIR, EXT == "tgz", COMPUTE_DATA_DIR)
 
@@ -13,6 +13,7 @@ sys.path.insert(0, workspace_dir)
 
 from src import datasets
 from src.datasets import (
+    add_fpart_to_env,
     extract_the_dataset_on_compute_node,
     move_data_to_compute_node,
     resolve_data_directories,
@@ -44,7 +45,7 @@ def main(args):
         LOCAL_OUTPUT_DIR,
     ) = resolve_data_directories(args)
 
-    os.system("module load Fpart/1.5.1-gcc-8.5.0")
+    add_fpart_to_env()
     move_data_to_compute_node(DATA_DIR, EXT == "tgz", COMPUTE_DATA_DIR)
 
     extract_the_dataset_on_compute_node(COMPUTE_DATA_DIR, EXT, TARGET_DIR)
@@ -1,11 +1,154 @@
 from datetime import datetime
-from itertools import product
+import functools
+import hashlib
+import inspect
+import math
 import os
+import sys
+import traceback
 import submitit
+import numpy as np
 import pandas as pd
 from src import paths
+from src import utils as src_utils
 from submission import explainers, training, grads, quant
-from src.utils import EXPERIMENT_PREFIX_SEP, get_experiment_prefix, get_save_path
+from src.utils import (
+    EXPERIMENT_PREFIX_SEP,
+    get_experiment_prefix_vec,
+    get_save_path_vec,
+)
+
+
+def _cartesian_df(cols):
+    """Builds the cartesian product of the values of cols as a DataFrame, in the
+    order of itertools.product, column by column instead of row tuple by row tuple.
+    Args:
+        cols (dict): column name to the list of its values.
+    """
+    sizes = [len(values) for values in cols.values()]
+    total = math.prod(sizes)
+    if total == 0:
+        return pd.DataFrame(columns=list(cols))
+    columns = {}
+    num_repeats, num_tiles = total, 1
+    for (name, values), size in zip(cols.items(), sizes):
+        num_repeats //= size
+        # filled elementwise, np.asarray would turn list values into a 2d array
+        column = np.empty(size, dtype=object)
+        for i, value in enumerate(values):
+            column[i] = value
+        if size < total:
+            # a broadcast view over the axis values, materialized once by the reshape
+            column = np.broadcast_to(
+                column.reshape(1, size, 1), (num_tiles, size, num_repeats)
+            ).reshape(-1)
+        columns[name] = column
+        num_tiles *= size
+    return pd.DataFrame(columns).infer_objects()
+
+
+def _scan_existing(paths):
+    """Same as paths.map(os.path.exists), but lists every distinct parent
+    directory once instead of issuing a stat per path.
+    Args:
+        paths (pd.Series): paths of files or directories.
+    """
+    paths = paths.map(os.path.normpath)
+    existing = set()
+    for dir_name in paths.map(os.path.dirname).unique():
+        try:
+            with os.scandir(dir_name or os.curdir) as entries:
+                existing.update(os.path.join(dir_name, entry.name) for entry in entries)
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+    return paths.isin(existing)
+
+
+SWEEPS_CACHE_DIR = "logs/sweeps"
+
+
+@functools.lru_cache(maxsize=1)
+def _sweep_code_digest():
+    # the derived columns are built by the code of these two modules, editing
+    # either of them invalidates the cached sweeps instead of reusing stale paths
+    digest = hashlib.blake2b(digest_size=16)
+    for module in (src_utils, sys.modules[__name__]):
+        digest.update(inspect.getsource(module).encode())
+    return digest.hexdigest()
+
+
+def _sweep_cache_key(kind, args):
+    # the derived paths depend on these roots as well
+    key = (
+        kind,
+        _sweep_code_digest(),
+        paths.CHECKPOINTS_DIR,
+        paths.LOCAL_OUTPUT_DIR,
+        sorted((name, repr(values)) for name, values in args.items()),
+    )
+    return hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()
+
+
+def _cached_sweep(kind, args, expand=None):
+    """Expands the sweep args to a DataFrame and adds the derived columns with
+    expand, memoized on disk by the sweep arguments. Pickle is used as the
+    columns hold enums and lists.
+    Args:
+        kind (str): name of the sweep, part of the cache key.
+        args (dict): column name to the list of its values.
+        expand (callable): adds the derived columns to the expanded DataFrame.
+    """
+    cache_path = os.path.join(SWEEPS_CACHE_DIR, f"{_sweep_cache_key(kind, args)}.pkl")
+    if os.path.exists(cache_path):
+        return pd.read_pickle(cache_path)
+    sweep = _cartesian_df(args)
+    if expand is not None:
+        sweep = expand(sweep)
+    os.makedirs(SWEEPS_CACHE_DIR, exist_ok=True)
+    sweep.to_pickle(cache_path)
+    return sweep
+
+
+def _expand_training(args):
+    args["tb_postfix"] = get_experiment_prefix_vec(args)
+    args["checkpoint_path"] = get_save_path_vec(args)
+    return args
+
+
+def _expand_explainers(args):
+    args["experiment_prefix"] = (
+        get_experiment_prefix_vec(args)
+        + EXPERIMENT_PREFIX_SEP
+        + args["explainer"].map(str)
+    )
+    args["experiment_output_dir"] = (
+        os.path.join(paths.LOCAL_OUTPUT_DIR, "") + args["experiment_prefix"]
+    )
+    args["checkpoint_path"] = get_save_path_vec(args)
+    return args
+
+
+def _expand_grads(args):
+    args["experiment_prefix"] = (
+        get_experiment_prefix_vec(args)
+        + EXPERIMENT_PREFIX_SEP
+        + args["e_gaussian_noise_var"].map(str)
+        + EXPERIMENT_PREFIX_SEP
+        + args["e_gaussian_blur_var"].map(str)
+    )
+    args["experiment_output_dir"] = (
+        os.path.join(paths.LOCAL_OUTPUT_DIR, "") + args["experiment_prefix"]
+    )
+    args["checkpoint_path"] = get_save_path_vec(args)
+
+    args.gaussian_noise_var = args.e_gaussian_noise_var
+    args.gaussian_blur_var = args.e_gaussian_blur_var
+    return args
+
+
+def _print_lines(values):
+    # one write for the whole column instead of a print per row
+    sys.stdout.write("".join(f"{value}\n" for value in values))
 
 
 def submit_training(
@@ -14,34 +157,18 @@ def submit_training(
     port,
     timeout,
     warmup_epochs_ratio,
+    pack_size=1,
     **args,
 ):
     # now = datetime.now().strftime("%Y%m%d-%H")
-    args = pd.DataFrame(
-        list(
-            product(
-                *args.values(),
-            )
-        ),
-        columns=args.keys(),
-    )
-    args["tb_postfix"] = args.apply(
-        lambda x: get_experiment_prefix(**x),
-        axis=1,
-    )
-    args["checkpoint_path"] = args.apply(
-        lambda x: get_save_path(
-            **x,
-        ),
-        axis=1,
-    )
+    args = _cached_sweep("training", args, _expand_training)
     dir_names = args["checkpoint_path"].apply(os.path.dirname)
     for checkpoint_path_dir_name in dir_names.unique():
         os.makedirs(checkpoint_path_dir_name, exist_ok=True)
 
-    checkpoint_exists = args["checkpoint_path"].apply(lambda x: os.path.exists(x))
+    checkpoint_exists = _scan_existing(args["checkpoint_path"])
     print("Checkpoints skipped because they do already exist")
-    args[checkpoint_exists]["checkpoint_path"].apply(print)
+    _print_lines(args.loc[checkpoint_exists, "checkpoint_path"])
 
     valid_args = args[~checkpoint_exists]
     valid_args["port"] = port
@@ -51,8 +178,10 @@ def submit_training(
         int
     )
     print("Valid args:")
-    valid_args["checkpoint_path"].apply(print)
-    return execute_job_submission(block_main, port, timeout, valid_args, training.main)
+    _print_lines(valid_args["checkpoint_path"])
+    return execute_job_submission(
+        block_main, port, timeout, valid_args, training.main, pack_size=pack_size
+    )
 
 
 def submit_explainers(
@@ -60,56 +189,30 @@ def submit_explainers(
     block_main,
     port,
     timeout,
+    pack_size=1,
     **args,
 ):
     print(f"time: {datetime.now()}")
-    args = pd.DataFrame(
-        list(
-            product(
-                *args.values(),
-            )
-        ),
-        columns=args.keys(),
-    )
+    args = _cached_sweep("explainers", args, _expand_explainers)
 
     args["port"] = port
     args["block_main"] = block_main
     args["timeout"] = timeout
-    args["experiment_prefix"] = args.apply(
-        lambda x: get_experiment_prefix(
-            **x,
-        )
-        + f"{EXPERIMENT_PREFIX_SEP}{x.explainer}",
-        axis=1,
-    )
-    args["experiment_output_dir"] = args.apply(
-        lambda x: os.path.join(
-            paths.LOCAL_OUTPUT_DIR,
-            x.experiment_prefix,
-        ),
-        axis=1,
-    )
-    args["checkpoint_path"] = args.apply(
-        lambda x: get_save_path(
-            **x,
-        ),
-        axis=1,
-    )
 
-    output_dir_exists = args["experiment_output_dir"].apply(lambda x: os.path.exists(x))
-    checkpoint_exists = args["checkpoint_path"].apply(lambda x: os.path.exists(x))
+    output_dir_exists = _scan_existing(args["experiment_output_dir"])
+    checkpoint_exists = _scan_existing(args["checkpoint_path"])
     valid_ids = checkpoint_exists & ~output_dir_exists
     valid_args = args[valid_ids]
 
     print("Checkpoints not available:")
-    args[~checkpoint_exists]["checkpoint_path"].apply(print)
+    _print_lines(args.loc[~checkpoint_exists, "checkpoint_path"])
     print("Output dirs skipped:")
-    args[output_dir_exists]["experiment_output_dir"].apply(print)
+    _print_lines(args.loc[output_dir_exists, "experiment_output_dir"])
     print("Valid args:")
-    args[valid_ids]["experiment_output_dir"].apply(print)
+    _print_lines(args.loc[valid_ids, "experiment_output_dir"])
 
     return execute_job_submission(
-        block_main, port, timeout, valid_args, explainers.main
+        block_main, port, timeout, valid_args, explainers.main, pack_size=pack_size
     )
 
 
@@ -118,58 +221,33 @@ def submit_grads(
     block_main,
     port,
     timeout,
+    pack_size=1,
     **args,
 ):
     print(f"time: {datetime.now()}")
-    args = pd.DataFrame(
-        list(
-            product(
-                *args.values(),
-            )
-        ),
-        columns=args.keys(),
-    )
+    args = _cached_sweep("grads", args, _expand_grads)
 
     args["port"] = port
     args["block_main"] = block_main
     args["timeout"] = timeout
-    args["experiment_prefix"] = args.apply(
-        lambda x: get_experiment_prefix(**x)
-        + f"{EXPERIMENT_PREFIX_SEP}{x.e_gaussian_noise_var}{EXPERIMENT_PREFIX_SEP}{x.e_gaussian_blur_var}",
-        axis=1,
-    )
-    args["experiment_output_dir"] = args.apply(
-        lambda x: os.path.join(
-            paths.LOCAL_OUTPUT_DIR,
-            x.experiment_prefix,
-        ),
-        axis=1,
-    )
-    args["checkpoint_path"] = args.apply(
-        lambda x: get_save_path(
-            **x,
-        ),
-        axis=1,
-    )
 
-    args.gaussian_noise_var = args.e_gaussian_noise_var
-    args.gaussian_blur_var = args.e_gaussian_blur_var
-
-    output_dir_exists = args["experiment_output_dir"].apply(lambda x: os.path.exists(x))
-    checkpoint_exists = args["checkpoint_path"].apply(lambda x: os.path.exists(x))
+    output_dir_exists = _scan_existing(args["experiment_output_dir"])
+    checkpoint_exists = _scan_existing(args["checkpoint_path"])
     valid_ids = checkpoint_exists & ~output_dir_exists
     valid_args = args[valid_ids]
 
     print("Checkpoints are available:")
-    args[checkpoint_exists]["checkpoint_path"].apply(print)
+    _print_lines(args.loc[checkpoint_exists, "checkpoint_path"])
     print("Checkpoints not available:")
-    args[~checkpoint_exists]["checkpoint_path"].apply(print)
+    _print_lines(args.loc[~checkpoint_exists, "checkpoint_path"])
     print("Output dirs skipped:")
-    args[output_dir_exists]["experiment_output_dir"].apply(print)
+    _print_lines(args.loc[output_dir_exists, "experiment_output_dir"])
     print("Valid args:")
-    args[valid_ids]["experiment_output_dir"].apply(print)
+    _print_lines(args.loc[valid_ids, "experiment_output_dir"])
 
-    return execute_job_submission(block_main, port, timeout, valid_args, grads.main)
+    return execute_job_submission(
+        block_main, port, timeout, valid_args, grads.main, pack_size=pack_size
+    )
 
 
 def submit_measurements(
@@ -177,17 +255,11 @@ def submit_measurements(
     block_main,
     port,
     timeout,
+    pack_size=1,
     **args,
 ):
     print(f"time: {datetime.now()}")
-    args = pd.DataFrame(
-        list(
-            product(
-                *args.values(),
-            )
-        ),
-        columns=args.keys(),
-    )
+    args = _cached_sweep("measurements", args)
 
     args["port"] = port
     args["block_main"] = block_main
@@ -202,9 +274,36 @@ def submit_measurements(
         num_gpus=0,
         cpus_per_task=16,
         mem_gb=64,
+        pack_size=pack_size,
     )
 
 
+def _records(args):
+    """Same as args.to_dict(orient="records"), zipping whole columns instead of
+    unboxing cell by cell."""
+    names = list(args.columns)
+    columns = [args[name].to_numpy(dtype=object) for name in names]
+    return [dict(zip(names, row)) for row in zip(*columns)]
+
+
+def _run_packed(func, pack):
+    # module level, so that submitit can pickle it
+    # a failing config does not cancel the ones packed after it
+    results, failures = [], []
+    for job_args in pack:
+        try:
+            results.append(func(job_args))
+        except Exception as e:
+            traceback.print_exc()
+            failures.append(f"{job_args}: {e!r}")
+    if failures:
+        raise RuntimeError(
+            f"{len(failures)} of {len(pack)} packed configs failed:\n"
+            + "\n".join(failures)
+        )
+    return results
+
+
 def execute_job_submission(
     block_main,
     port,
@@ -214,9 +313,11 @@ def execute_job_submission(
     num_gpus=1,
     cpus_per_task=16,
     mem_gb=64,
+    pack_size=1,
 ):
-    jobs_args = args.to_dict(orient="records")
-
+    """Submits one slurm array task per pack of pack_size rows of args, the
+    rows of a pack run one after the other in the same task.
+    """
     repr_args = args.copy()
     repr_args = repr_args.map(str)
     nunique = repr_args.nunique()
@@ -233,7 +334,9 @@ def execute_job_submission(
 
     if port != None:
         print("Running only the first job because of the debug flag")
-        jobs_args = [jobs_args[0]]
+        jobs_args = _records(args.iloc[:1])
+    else:
+        jobs_args = _records(args)
 
     print("Do you want to continue? [y/n]", flush=True)
     if input() != "y":
@@ -243,7 +346,7 @@ def execute_job_submission(
     print("submitting jobs")
     executor = submitit.AutoExecutor(folder="logs/%j")
     executor.update_parameters(
-        timeout_min=timeout,
+        timeout_min=timeout * pack_size,
         cpus_per_task=cpus_per_task,
         mem_gb=mem_gb,
         slurm_additional_parameters={
@@ -257,11 +360,14 @@ def execute_job_submission(
         print("Running in locally")
         func(jobs_args)
     else:
-        jobs = executor.map_array(func, jobs_args)
-        print("Job submitted")
+        packs = [
+            jobs_args[i : i + pack_size] for i in range(0, len(jobs_args), pack_size)
+        ]
+        jobs = executor.map_array(functools.partial(_run_packed, func), packs)
+        print(f"Job submitted as {len(packs)} tasks")
         # wait until the job has finished
         if block_main:
             print("Waiting for job to finish")
-            results = [job.result() for job in jobs]
+            results = [result for job in jobs for result in job.result()]
             print("All jobs finished")
             return results